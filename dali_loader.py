@@ -0,0 +1,88 @@
+import random
+
+from nvidia.dali import fn, types
+from nvidia.dali.pipeline import Pipeline
+from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+
+
+def build_dali_pipeline(image_paths, labels, batch_size, resize, mean, std, shuffle=False, pad_last_batch=False,
+                        shard_id=0, num_shards=1, device_id=0, num_threads=4, seed=42):
+    """ JPEG decode (nvJPEG) -> resize -> normalize, equivalent to `BaseAugmentation`, in HWC layout.
+
+    Args:
+        image_paths (list of str): image files to read.
+        labels (list of int): multi class label of each image.
+        resize (list of int): (height, width) of the output images.
+        mean, std (sequence of float): normalization statistics in [0, 1] scale.
+        shuffle (bool): reshuffle the whole file list every epoch, like `DataLoader(shuffle=True)`.
+        pad_last_batch (bool): pad the last batch of the shard so it can be returned as a partial batch.
+        shard_id, num_shards (int): rank / world size for distributed training.
+    """
+    pipe = Pipeline(batch_size=batch_size, num_threads=num_threads, device_id=device_id, seed=seed)
+    with pipe:
+        jpegs, targets = fn.readers.file(
+            files=image_paths,
+            labels=labels,
+            shuffle_after_epoch=shuffle,
+            pad_last_batch=pad_last_batch,
+            shard_id=shard_id,
+            num_shards=num_shards,
+            name="Reader",
+        )
+        images = fn.decoders.image(jpegs, device="mixed", output_type=types.RGB)
+        images = fn.resize(images, resize_y=resize[0], resize_x=resize[1], interp_type=types.INTERP_LINEAR)
+        images = fn.crop_mirror_normalize(
+            images,
+            dtype=types.FLOAT,
+            output_layout="HWC",
+            mean=[m * 255 for m in mean],
+            std=[s * 255 for s in std],
+        )
+        pipe.set_outputs(images, targets.gpu())
+    return pipe
+
+
+class DALILoader:
+    """ Iterate a DALI pipeline like a DataLoader, yielding (inputs, labels) already on the GPU.
+
+    Images come out of the pipeline as NHWC and are returned as an NCHW view, i.e. in channels_last.
+    """
+
+    def __init__(self, pipeline, drop_last=True):
+        self.iterator = DALIGenericIterator(
+            pipeline,
+            ["data", "label"],
+            reader_name="Reader",
+            last_batch_policy=LastBatchPolicy.DROP if drop_last else LastBatchPolicy.PARTIAL,
+            auto_reset=True,
+        )
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]["data"].permute(0, 3, 1, 2), batch[0]["label"].squeeze(-1).long()
+
+
+def build_dali_loader(dataset, subset, batch_size, resize, shuffle=False, drop_last=True,
+                      shard_id=0, num_shards=1, device_id=0, num_threads=4, seed=42):
+    """ Build a `DALILoader` over the images of `subset`, a `Subset` of a `MaskBaseDataset`. """
+    indices = list(subset.indices)
+    if shuffle:
+        # shuffle_after_epoch only reshuffles from the second epoch on, so permute the first one here;
+        # the seed is shared by all ranks so shards stay disjoint
+        random.Random(seed).shuffle(indices)
+    image_paths = [dataset.image_paths[i] for i in indices]
+    labels = [
+        int(dataset.encode_multi_class(
+            dataset.get_mask_label(i), dataset.get_gender_label(i), dataset.get_age_label(i)
+        ))
+        for i in indices
+    ]
+    pipeline = build_dali_pipeline(
+        image_paths, labels, batch_size, resize, dataset.mean, dataset.std, shuffle=shuffle,
+        pad_last_batch=not drop_last, shard_id=shard_id, num_shards=num_shards, device_id=device_id,
+        num_threads=num_threads, seed=seed,
+    )
+    return DALILoader(pipeline, drop_last=drop_last)
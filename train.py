@@ -1,4 +1,5 @@
 import argparse
+import fcntl
 import glob
 import json
 import multiprocessing
@@ -11,20 +12,33 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.cuda.amp import GradScaler, autocast
 from torch.optim.lr_scheduler import StepLR
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
 from dataset import MaskBaseDataset
 from loss import create_criterion
 
 
-def seed_everything(seed):
+def seed_everything(seed, deterministic=False):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cuda.matmul.allow_tf32 = False
+        torch.backends.cudnn.allow_tf32 = False
+    else:
+        # input size is fixed, so let cuDNN autotune conv algorithms and use TF32 on Ampere
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     np.random.seed(seed)
     random.seed(seed)
 
@@ -34,19 +48,35 @@ def get_lr(optimizer):
         return param_group['lr']
 
 
-def grid_image(np_images, gts, preds, n=16, shuffle=False):
-    batch_size = np_images.shape[0]
-    assert n <= batch_size
+def macro_f1(confusion):
+    """ Macro F1 from a (num_classes, num_classes) confusion matrix indexed by [gt, pred].
+
+    Classes without any gt or pred contribute 0, as sklearn's zero_division=0.
+    """
+    confusion = confusion.float()
+    tp = confusion.diag()
+    precision = tp / confusion.sum(dim=0).clamp(min=1)
+    recall = tp / confusion.sum(dim=1).clamp(min=1)
+    f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+    return f1.mean().item()
+
 
-    choices = random.choices(range(batch_size), k=n) if shuffle else list(range(n))
-    figure = plt.figure(figsize=(12, 18 + 2))  # cautions: hardcoded, 이미지 크기에 따라 figsize 를 조정해야 할 수 있습니다. T.T
-    plt.subplots_adjust(top=0.8)               # cautions: hardcoded, 이미지 크기에 따라 top 를 조정해야 할 수 있습니다. T.T
-    n_grid = np.ceil(n ** 0.5)
+def grid_image(np_images, gts, preds, n=16, figure=None):
+    """ Draw the given images (at most n) with their gt / pred labels on a grid of n cells,
+    reusing the axes of `figure` if given. gts / preds are expected on CPU.
+    """
+    assert len(np_images) <= n
+
+    n_grid = int(np.ceil(n ** 0.5))
+    if figure is None:
+        figure, _ = plt.subplots(n_grid, n_grid, figsize=(12, 18 + 2))  # cautions: hardcoded, 이미지 크기에 따라 figsize 를 조정해야 할 수 있습니다. T.T
+        figure.subplots_adjust(top=0.8)                                 # cautions: hardcoded, 이미지 크기에 따라 top 를 조정해야 할 수 있습니다. T.T
+    axes = figure.axes
+    for ax in axes:
+        ax.clear()
+        ax.axis("off")
     tasks = ["mask", "gender", "age"]
-    for idx, choice in enumerate(choices):
-        gt = gts[choice].item()
-        pred = preds[choice].item()
-        image = np_images[choice]
+    for idx, (image, gt, pred) in enumerate(zip(np_images, gts.tolist(), preds.tolist())):
         # title = f"gt: {gt}, pred: {pred}"
         gt_decoded_labels = MaskBaseDataset.decode_multi_class(gt)
         pred_decoded_labels = MaskBaseDataset.decode_multi_class(pred)
@@ -56,11 +86,13 @@ def grid_image(np_images, gts, preds, n=16, shuffle=False):
             in zip(gt_decoded_labels, pred_decoded_labels, tasks)
         ])
 
-        plt.subplot(n_grid, n_grid, idx + 1, title=title)
-        plt.xticks([])
-        plt.yticks([])
-        plt.grid(False)
-        plt.imshow(image, cmap=plt.cm.binary)
+        ax = axes[idx]
+        ax.axis("on")
+        ax.set_title(title)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.grid(False)
+        ax.imshow(image, cmap=plt.cm.binary)
 
     return figure
 
@@ -76,21 +108,109 @@ def increment_path(path, exist_ok=False):
     if (path.exists() and exist_ok) or (not path.exists()):
         return str(path)
     else:
-        dirs = glob.glob(f"{path}*")
-        matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
-        i = [int(m.groups()[0]) for m in matches if m]
-        n = max(i) + 1 if i else 2
+        # the last used suffix is kept in a hidden counter file next to the runs,
+        # so sweeps with many runs don't rescan the whole directory
+        counter_path = path.parent / f".{path.name}.ctr"
+        fd = os.open(counter_path, os.O_CREAT | os.O_RDWR)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            last = f.read().strip()
+            if last:
+                n = int(last) + 1
+            else:  # no counter yet: fall back to scanning existing runs once
+                dirs = glob.glob(f"{path}*")
+                matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
+                i = [int(m.groups()[0]) for m in matches if m]
+                n = max(i) + 1 if i else 2
+            # skip suffixes taken without going through the counter (e.g. explicit --name exp3)
+            while Path(f"{path}{n}").exists():
+                n += 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(n))
         return f"{path}{n}"
 
 
-def train(data_dir, model_dir, args):
-    seed_everything(args.seed)
+def setup_distributed():
+    """ Initialize the NCCL process group when launched with multiple processes.
+
+    Reads the environment variables set by `torch.distributed.launch --use_env`.
+
+    Returns:
+        (rank, local_rank, world_size), (0, 0, 1) for single-process runs.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 0, 1
+
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group("nccl")
+    return dist.get_rank(), local_rank, world_size
+
+
+class Prefetcher:
+    """ Overlap host-to-device copies of the next batch with the current step.
+
+    The next batch is copied on a side CUDA stream while the default stream runs
+    forward/backward. On CPU this simply iterates the wrapped loader.
+
+    Args:
+        loader (DataLoader): loader yielding (inputs, labels) batches.
+        device (torch.device): device the batches are moved to.
+        memory_format (torch.memory_format): memory format of the moved inputs.
+    """
 
-    save_dir = increment_path(os.path.join(model_dir, args.name))
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.use_cuda = device.type == "cuda"
+        self.stream = torch.cuda.Stream(device) if self.use_cuda else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if not self.use_cuda:
+            for inputs, labels in self.loader:
+                yield inputs.contiguous(memory_format=self.memory_format), labels
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self.preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            inputs, labels = next_batch
+            # tensors were allocated on the side stream; keep them alive for the consumer
+            inputs.record_stream(torch.cuda.current_stream(self.device))
+            labels.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self.preload(loader_iter)
+            yield inputs, labels
+
+    def preload(self, loader_iter):
+        try:
+            inputs, labels = next(loader_iter)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            labels = labels.to(self.device, non_blocking=True)
+        return inputs, labels
+
+
+def train(data_dir, model_dir, args):
+    seed_everything(args.seed, args.deterministic)
 
     # -- settings
+    rank, local_rank, world_size = setup_distributed()
+    distributed = world_size > 1
+    is_main = rank == 0
     use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    device = torch.device(f"cuda:{local_rank}" if distributed else "cuda" if use_cuda else "cpu")
+
+    save_dir = increment_path(os.path.join(model_dir, args.name)) if is_main else None
 
     # -- dataset
     dataset_module = getattr(import_module("dataset"), args.dataset)  # default: BaseAugmentation
@@ -111,30 +231,67 @@ def train(data_dir, model_dir, args):
     # -- data_loader
     train_set, val_set = dataset.split_dataset()
 
-    train_loader = DataLoader(
-        train_set,
-        batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
-        shuffle=True,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
-
-    val_loader = DataLoader(
-        val_set,
-        batch_size=args.valid_batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
-        shuffle=False,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
+    train_sampler = None
+    if args.dali:
+        # GPU decode + resize + normalize, equivalent to BaseAugmentation
+        if not use_cuda or args.augmentation != "BaseAugmentation":
+            raise ValueError("--dali requires CUDA and --augmentation BaseAugmentation")
+        from dali_loader import build_dali_loader
+
+        dali_kwargs = dict(
+            resize=args.resize,
+            shard_id=rank,
+            num_shards=world_size,
+            device_id=local_rank,
+            num_threads=max(args.num_workers, 1),
+            seed=args.seed,
+        )
+        train_loader = build_dali_loader(dataset, train_set, args.batch_size, shuffle=True, **dali_kwargs)
+        val_loader = build_dali_loader(
+            dataset, val_set, args.valid_batch_size, shuffle=False, drop_last=False, **dali_kwargs
+        )
+    else:
+        # persistent_workers / prefetch_factor are only valid with worker processes
+        worker_kwargs = dict(
+            persistent_workers=True,
+            prefetch_factor=args.prefetch_factor,
+        ) if args.num_workers > 0 else {}
+
+        train_sampler = DistributedSampler(train_set) if distributed else None
+        # shard validation without DistributedSampler's padding so no sample is counted twice
+        val_shard = Subset(val_set, range(rank, len(val_set), world_size)) if distributed else val_set
+
+        train_loader = DataLoader(
+            train_set,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
+            pin_memory=use_cuda,
+            drop_last=True,
+            **worker_kwargs,
+        )
+
+        val_loader = DataLoader(
+            val_shard,
+            batch_size=args.valid_batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+            pin_memory=use_cuda,
+            drop_last=False,
+            **worker_kwargs,
+        )
 
     # -- model
     model_module = getattr(import_module("model"), args.model)  # default: BaseModel
     model = model_module(
         num_classes=num_classes
     ).to(device)
-    model = torch.nn.DataParallel(model)
+    model = model.to(memory_format=torch.channels_last)
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank])
+    else:
+        model = torch.nn.DataParallel(model)
 
     # -- loss & metric
     criterion = create_criterion(args.criterion)  # default: cross_entropy
@@ -145,38 +302,54 @@ def train(data_dir, model_dir, args):
         weight_decay=5e-4
     )
     scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
+    scaler = GradScaler(enabled=use_cuda)
 
     # -- logging
-    logger = SummaryWriter(log_dir=save_dir)
-    with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
-        json.dump(vars(args), f, ensure_ascii=False, indent=4)
+    if is_main:
+        logger = SummaryWriter(log_dir=save_dir)
+        with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump(vars(args), f, ensure_ascii=False, indent=4)
+
+    # denormalization constants for the validation figure
+    mean_t = torch.tensor(dataset.mean, dtype=torch.float, device=device).view(1, 3, 1, 1)
+    std_t = torch.tensor(dataset.std, dtype=torch.float, device=device).view(1, 3, 1, 1)
+
+    if args.dali:  # batches already come out of DALI on the GPU, in channels_last
+        train_batches, val_batches = train_loader, val_loader
+    else:
+        train_batches = Prefetcher(train_loader, device, memory_format=torch.channels_last)
+        val_batches = Prefetcher(val_loader, device, memory_format=torch.channels_last)
 
     best_val_acc = 0
     best_val_loss = np.inf
+    figure = None  # reused across epochs
     for epoch in range(args.epochs):
         # train loop
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
-        loss_value = 0
-        matches = 0
-        for idx, train_batch in enumerate(train_loader):
+        loss_value = torch.zeros((), device=device)
+        matches = torch.zeros((), dtype=torch.long, device=device)
+        for idx, train_batch in enumerate(train_batches):
             inputs, labels = train_batch
-            inputs = inputs.to(device)
-            labels = labels.to(device)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
-            outs = model(inputs)
+            with autocast(enabled=use_cuda):
+                outs = model(inputs)
+                loss = criterion(outs, labels)
             preds = torch.argmax(outs, dim=-1)
-            loss = criterion(outs, labels)
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            loss_value += loss.item()
-            matches += (preds == labels).sum().item()
-            if (idx + 1) % args.log_interval == 0:
-                train_loss = loss_value / args.log_interval
-                train_acc = matches / args.batch_size / args.log_interval
+            # accumulate on device; only sync with the host at log time
+            loss_value += loss.detach().float()
+            matches += (preds == labels).sum()
+            if (idx + 1) % args.log_interval == 0 and is_main:
+                train_loss = loss_value.item() / args.log_interval
+                train_acc = matches.item() / args.batch_size / args.log_interval
                 current_lr = get_lr(optimizer)
                 print(
                     f"Epoch[{epoch}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
@@ -185,40 +358,60 @@ def train(data_dir, model_dir, args):
                 logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
                 logger.add_scalar("Train/accuracy", train_acc, epoch * len(train_loader) + idx)
 
-                loss_value = 0
-                matches = 0
+                loss_value.zero_()
+                matches.zero_()
 
         scheduler.step()
 
         # val loop
         with torch.no_grad():
-            print("Calculating validation results...")
+            if is_main:
+                print("Calculating validation results...")
             model.eval()
-            val_loss_items = []
-            val_acc_items = []
-            figure = None
-            for val_batch in val_loader:
+            val_loss_sum = torch.zeros((), device=device)
+            val_acc_sum = torch.zeros((), dtype=torch.long, device=device)
+            val_count = torch.zeros((), dtype=torch.long, device=device)
+            confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+            log_figure = args.fig_log_interval > 0 and epoch % args.fig_log_interval == 0
+            figure_pending = log_figure and is_main
+            for val_batch in val_batches:
                 inputs, labels = val_batch
-                inputs = inputs.to(device)
-                labels = labels.to(device)
 
-                outs = model(inputs)
+                with autocast(enabled=use_cuda):
+                    outs = model(inputs)
+                    val_loss_sum += criterion(outs, labels).float() * labels.numel()
                 preds = torch.argmax(outs, dim=-1)
 
-                loss_item = criterion(outs, labels).item()
-                acc_item = (labels == preds).sum().item()
-                val_loss_items.append(loss_item)
-                val_acc_items.append(acc_item)
-
-                if figure is None:
-                    inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
-                    inputs_np = dataset_module.denormalize_image(inputs_np, dataset.mean, dataset.std)
+                val_acc_sum += (labels == preds).sum()
+                val_count += labels.numel()
+                confusion += torch.bincount(labels * num_classes + preds, minlength=num_classes * num_classes)
+
+                if figure_pending:
+                    n = 16
+                    shuffle = args.dataset != "MaskSplitByProfileDataset"
+                    batch_size = inputs.size(0)
+                    choices = random.choices(range(batch_size), k=n) if shuffle else list(range(min(n, batch_size)))
+                    # denormalize only the sampled images, on device, before copying them to host
+                    images = (inputs[choices].float() * std_t + mean_t) * 255.0
+                    images_np = images.clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
                     figure = grid_image(
-                        inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
+                        images_np, labels[choices].cpu(), preds[choices].cpu(), n=n, figure=figure
                     )
+                    figure_pending = False
+
+            if distributed:
+                dist.all_reduce(val_loss_sum)
+                dist.all_reduce(val_acc_sum)
+                dist.all_reduce(val_count)
+                dist.all_reduce(confusion)
+            # normalise by the samples actually evaluated, batches may be partial
+            val_count = max(val_count.item(), 1)
+            val_loss = val_loss_sum.item() / val_count
+            val_acc = val_acc_sum.item() / val_count
+            val_f1 = macro_f1(confusion.view(num_classes, num_classes))
+            if not is_main:
+                continue
 
-            val_loss = np.sum(val_loss_items) / len(val_loader)
-            val_acc = np.sum(val_acc_items) / len(val_set)
             best_val_loss = min(best_val_loss, val_loss)
             if val_acc > best_val_acc:
                 print(f"New best model for val accuracy : {val_acc:4.2%}! saving the best model..")
@@ -226,14 +419,19 @@ def train(data_dir, model_dir, args):
                 best_val_acc = val_acc
             torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
             print(
-                f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2} || "
+                f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2}, f1: {val_f1:4.4} || "
                 f"best acc : {best_val_acc:4.2%}, best loss: {best_val_loss:4.2}"
             )
             logger.add_scalar("Val/loss", val_loss, epoch)
             logger.add_scalar("Val/accuracy", val_acc, epoch)
-            logger.add_figure("results", figure, epoch)
+            logger.add_scalar("Val/f1", val_f1, epoch)
+            if log_figure and figure is not None:
+                logger.add_figure("results", figure, epoch, close=False)
             print()
 
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -244,11 +442,15 @@ if __name__ == '__main__':
 
     # Data and model checkpoints directories
     parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    parser.add_argument('--deterministic', action='store_true', help='use deterministic cuDNN kernels and disable TF32 for reproducible runs, at the cost of throughput (default: False)')
     parser.add_argument('--epochs', type=int, default=1, help='number of epochs to train (default: 1)')
     parser.add_argument('--dataset', type=str, default='MaskBaseDataset', help='dataset augmentation type (default: MaskBaseDataset)')
     parser.add_argument('--augmentation', type=str, default='BaseAugmentation', help='data augmentation type (default: BaseAugmentation)')
     parser.add_argument("--resize", nargs="+", type=list, default=[128, 96], help='resize size for image when training')
     parser.add_argument('--batch_size', type=int, default=64, help='input batch size for training (default: 64)')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count() // 2, help='number of data loading workers (default: cpu_count // 2)')
+    parser.add_argument('--prefetch_factor', type=int, default=4, help='batches loaded in advance by each worker (default: 4)')
+    parser.add_argument('--dali', action='store_true', help='load data with an NVIDIA DALI pipeline (GPU JPEG decoding, BaseAugmentation only)')
     parser.add_argument('--valid_batch_size', type=int, default=1000, help='input batch size for validing (default: 1000)')
     parser.add_argument('--model', type=str, default='BaseModel', help='model type (default: BaseModel)')
     parser.add_argument('--optimizer', type=str, default='SGD', help='optimizer type (default: SGD)')
@@ -257,6 +459,7 @@ if __name__ == '__main__':
     parser.add_argument('--criterion', type=str, default='cross_entropy', help='criterion type (default: cross_entropy)')
     parser.add_argument('--lr_decay_step', type=int, default=20, help='learning rate scheduler deacy step (default: 20)')
     parser.add_argument('--log_interval', type=int, default=20, help='how many batches to wait before logging training status')
+    parser.add_argument('--fig_log_interval', type=int, default=1, help='how many epochs to wait before logging the validation figure, 0 to disable (default: 1)')
     parser.add_argument('--name', default='exp', help='model save at {SM_MODEL_DIR}/{name}')
 
     # Container environment